@@ -19,17 +19,17 @@ class GroupNorm32(nn.GroupNorm):
         return super().forward(x.float()).type(x.dtype)
 
 
+CONV_ND = {1: nn.Conv1d, 2: nn.Conv2d, 3: nn.Conv3d}
+AVG_POOL_ND = {1: nn.AvgPool1d, 2: nn.AvgPool2d, 3: nn.AvgPool3d}
+
+
 def conv_nd(dims, *args, **kwargs):
     """
     Create a 1D, 2D, or 3D convolution module.
     """
-    if dims == 1:
-        return nn.Conv1d(*args, **kwargs)
-    elif dims == 2:
-        return nn.Conv2d(*args, **kwargs)
-    elif dims == 3:
-        return nn.Conv3d(*args, **kwargs)
-    raise ValueError(f"unsupported dimensions: {dims}")
+    if dims not in CONV_ND:
+        raise ValueError(f"unsupported dimensions: {dims}")
+    return CONV_ND[dims](*args, **kwargs)
 
 def layer_norm(shape, *args, **kwargs):
 
@@ -46,13 +46,9 @@ def avg_pool_nd(dims, *args, **kwargs):
     """
     Create a 1D, 2D, or 3D average pooling module.
     """
-    if dims == 1:
-        return nn.AvgPool1d(*args, **kwargs)
-    elif dims == 2:
-        return nn.AvgPool2d(*args, **kwargs)
-    elif dims == 3:
-        return nn.AvgPool3d(*args, **kwargs)
-    raise ValueError(f"unsupported dimensions: {dims}")
+    if dims not in AVG_POOL_ND:
+        raise ValueError(f"unsupported dimensions: {dims}")
+    return AVG_POOL_ND[dims](*args, **kwargs)
 
 
 def update_ema(target_params, source_params, rate=0.99):
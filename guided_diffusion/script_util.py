@@ -44,6 +44,8 @@ def model_and_diffusion_defaults():
         resblock_updown=False,
         use_fp16=False,
         use_new_attention_order=False,
+        use_compile=False,
+        share_pathways=False,
         dpm_solver = False,
         version = 'new',
     )
@@ -76,6 +78,8 @@ def create_model_and_diffusion(
     resblock_updown,
     use_fp16,
     use_new_attention_order,
+    use_compile,
+    share_pathways,
     dpm_solver,
     version,
 ):
@@ -97,6 +101,8 @@ def create_model_and_diffusion(
         resblock_updown=resblock_updown,
         use_fp16=use_fp16,
         use_new_attention_order=use_new_attention_order,
+        use_compile=use_compile,
+        share_pathways=share_pathways,
         version = version,
     )
     diffusion = create_gaussian_diffusion(
@@ -131,6 +137,8 @@ def create_model(
     resblock_updown=False,
     use_fp16=False,
     use_new_attention_order=False,
+    use_compile=False,
+    share_pathways=False,
     version = 'new',
 ):
     if channel_mult == "":
@@ -171,6 +179,8 @@ def create_model(
         use_scale_shift_norm=use_scale_shift_norm,
         resblock_updown=resblock_updown,
         use_new_attention_order=use_new_attention_order,
+        use_compile=use_compile,
+        share_pathways=share_pathways,
     ) if version == 'new' else None
 
 def create_gaussian_diffusion(
@@ -1,13 +1,12 @@
 from abc import abstractmethod
-import math
 import numpy as np
-import torch as th
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from collections import OrderedDict
-from .fp16_util import convert_module_to_f16, convert_module_to_f32
 from copy import deepcopy
+from functools import partial
 from guided_diffusion.utils import softmax_helper,sigmoid_helper
 from guided_diffusion.utils import InitWeights_He
 from batchgenerators.augmentations.utils import pad_nd_image
@@ -15,9 +14,7 @@ from guided_diffusion.utils import no_op
 from guided_diffusion.utils import to_cuda, maybe_to_torch
 from scipy.ndimage.filters import gaussian_filter
 from typing import Union, Tuple, List
-from torch.cuda.amp import autocast
 from guided_diffusion.nn import (
-    checkpoint,
     conv_nd,
     linear,
     avg_pool_nd,
@@ -56,6 +53,40 @@ class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
         return x
 
 
+def raise_compile_cache_limit(num_entries):
+    """
+    Let TorchDynamo keep at least `num_entries` compiled variants per code object.
+
+    All compiled blocks of a class share the code object of their _forward, and
+    Dynamo's cache lives on that code object. Every distinct block configuration
+    (channels, resolution, up/down), and on torch < 2.5 every block instance,
+    adds a cache entry. Once the default limit of 8 is hit, the remaining blocks
+    silently fall back to eager.
+
+    :param num_entries: the number of compiled blocks sharing one code object.
+    """
+    import torch._dynamo
+
+    config = torch._dynamo.config
+    config.cache_size_limit = max(config.cache_size_limit, num_entries)
+    if hasattr(config, "accumulated_cache_size_limit"):
+        config.accumulated_cache_size_limit = max(
+            config.accumulated_cache_size_limit, num_entries
+        )
+
+
+def nearest_conv_to_transposed(weight):
+    """
+    Fold a 3x3 convolution applied after 2x nearest upsampling into a transposed
+    convolution with kernel 4, stride 2 and padding 1 that computes the same output.
+
+    :param weight: an [out x in x 3 x 3] Conv2d weight.
+    :return: the equivalent [in x out x 4 x 4] ConvTranspose2d weight.
+    """
+    fold = weight.new_tensor([[0, 0, 1], [0, 1, 1], [1, 1, 0], [1, 0, 0]])
+    return torch.einsum("ai,bj,oyij->yoab", fold, fold, weight)
+
+
 class Upsample(nn.Module):
     """
     An upsampling layer with an optional convolution.
@@ -72,11 +103,35 @@ class Upsample(nn.Module):
         self.out_channels = out_channels or channels
         self.use_conv = use_conv
         self.dims = dims
-        if use_conv:
+        if use_conv and dims == 2:
+            # Upsample and convolve in one pass, starting from the same function as
+            # nearest upsampling followed by a freshly initialized 3x3 conv.
+            conv = conv_nd(dims, self.channels, self.out_channels, 3, padding=1)
+            self.conv = nn.ConvTranspose2d(
+                self.channels, self.out_channels, 4, stride=2, padding=1
+            )
+            with torch.no_grad():
+                self.conv.weight.copy_(nearest_conv_to_transposed(conv.weight))
+                self.conv.bias.copy_(conv.bias)
+        elif use_conv:
             self.conv = conv_nd(dims, self.channels, self.out_channels, 3, padding=1)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the transposed-conv rewrite hold 3x3 conv weights.
+        key = prefix + "conv.weight"
+        if (
+            self.use_conv
+            and self.dims == 2
+            and key in state_dict
+            and state_dict[key].shape[-1] == 3
+        ):
+            state_dict[key] = nearest_conv_to_transposed(state_dict[key])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
         assert x.shape[1] == self.channels
+        if self.use_conv and self.dims == 2:
+            return self.conv(x)
         if self.dims == 3:
             x = F.interpolate(
                 x, (x.shape[2], x.shape[3] * 2, x.shape[4] * 2), mode="nearest"
@@ -153,6 +208,9 @@ class ResBlock(TimestepBlock):
     :param use_checkpoint: if True, use gradient checkpointing on this module.
     :param up: if True, use this block for upsampling.
     :param down: if True, use this block for downsampling.
+    :param use_compile: if True, run _forward through torch.compile so the
+        normalization, scale-shift and activation ops are fused with the
+        neighbouring convolutions.
     """
 
     def __init__(
@@ -167,6 +225,7 @@ class ResBlock(TimestepBlock):
         use_checkpoint=False,
         up=False,
         down=False,
+        use_compile=False,
     ):
         super().__init__()
         self.channels = channels
@@ -176,6 +235,11 @@ class ResBlock(TimestepBlock):
         self.use_conv = use_conv
         self.use_checkpoint = use_checkpoint
         self.use_scale_shift_norm = use_scale_shift_norm
+        # The unbound method is compiled so that deep copies of this block (e.g. the
+        # Bernoulli pathway) still run against their own parameters.
+        self._compiled_forward = (
+            torch.compile(ResBlock._forward, dynamic=False) if use_compile else None
+        )
 
         self.in_layers = nn.Sequential(
             normalization(channels),
@@ -227,9 +291,12 @@ class ResBlock(TimestepBlock):
         :param emb: an [N x emb_channels] Tensor of timestep embeddings.
         :return: an [N x C x ...] Tensor of outputs.
         """
-        return checkpoint(
-            self._forward, (x, emb), self.parameters(), self.use_checkpoint
-        )
+        forward_fn = self._forward
+        if self._compiled_forward is not None:
+            forward_fn = partial(self._compiled_forward, self)
+        if self.use_checkpoint and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(forward_fn, x, emb, use_reentrant=False)
+        return forward_fn(x, emb)
 
     def _forward(self, x, emb):
         if self.updown:
@@ -241,15 +308,15 @@ class ResBlock(TimestepBlock):
         else:
             h = self.in_layers(x)
         emb_out = self.emb_layers(emb).type(h.dtype)
-        while len(emb_out.shape) < len(h.shape):
-            emb_out = emb_out[..., None]
+        # Singleton spatial dims so the [N x C] embedding broadcasts over h.
+        spatial_ones = [1] * (h.dim() - 2)
         if self.use_scale_shift_norm:
             out_norm, out_rest = self.out_layers[0], self.out_layers[1:]
-            scale, shift = th.chunk(emb_out, 2, dim=1)
+            scale, shift = emb_out.view(emb_out.shape[0], 2, -1, *spatial_ones).unbind(1)
             h = out_norm(h) * (1 + scale) + shift
             h = out_rest(h)
         else:
-            h = h + emb_out
+            h = h + emb_out.view(*emb_out.shape, *spatial_ones)
             h = self.out_layers(h)
         return self.skip_connection(x) + h
 
@@ -269,6 +336,7 @@ class AttentionBlock(nn.Module):
         num_head_channels=-1,
         use_checkpoint=False,
         use_new_attention_order=False,
+        use_compile=False,
     ):
         super().__init__()
         self.channels = channels
@@ -280,8 +348,13 @@ class AttentionBlock(nn.Module):
             ), f"q,k,v channels {channels} is not divisible by num_head_channels {num_head_channels}"
             self.num_heads = channels // num_head_channels
         self.use_checkpoint = use_checkpoint
+        # norm -> qkv -> attention -> proj_out compiles into a single graph.
+        self._compiled_forward = (
+            torch.compile(AttentionBlock._forward, dynamic=False) if use_compile else None
+        )
         self.norm = normalization(channels)
-        self.qkv = conv_nd(1, channels, channels * 3, 1)
+        # 1x1 convolutions over the flattened tokens, expressed as plain linear layers.
+        self.qkv = linear(channels, channels * 3)
         if use_new_attention_order: # THIS IS NOT BEING USED
             # split qkv before split heads
             self.attention = QKVAttention(self.num_heads)
@@ -289,18 +362,35 @@ class AttentionBlock(nn.Module):
             # split heads before split qkv
             self.attention = QKVAttentionLegacy(self.num_heads)
 
-        self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
+        self.proj_out = zero_module(linear(channels, channels))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the switch to nn.Linear hold [out x in x 1] conv weights.
+        for name in ("qkv", "proj_out"):
+            key = prefix + name + ".weight"
+            if key in state_dict and state_dict[key].dim() == 3:
+                state_dict[key] = state_dict[key].squeeze(-1)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
-        return checkpoint(self._forward, (x,), self.parameters(), True)
+        forward_fn = self._forward
+        if self._compiled_forward is not None:
+            forward_fn = partial(self._compiled_forward, self)
+        if self.use_checkpoint and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(forward_fn, x, use_reentrant=False)
+        return forward_fn(x)
 
     def _forward(self, x):
         b, c, *spatial = x.shape
         x = x.reshape(b, c, -1)
-        qkv = self.qkv(self.norm(x))
+        # The projections act on [N x T x C] tokens, the layout channels_last inputs already have.
+        qkv = self.qkv(self.norm(x).transpose(1, 2)).transpose(1, 2)
         h = self.attention(qkv)
-        h = self.proj_out(h)
-        return (x + h).reshape(b, c, *spatial)
+        h = self.proj_out(h.transpose(1, 2))
+        # The residual is accumulated into the fresh projection output, which autograd does
+        # not need, instead of allocating a separate sum.
+        h.add_(x.transpose(1, 2))
+        return h.transpose(1, 2).reshape(b, c, *spatial)
 
 
 def count_flops_attn(model, _x, y):
@@ -320,7 +410,7 @@ def count_flops_attn(model, _x, y):
     # The first computes the weight matrix, the second computes
     # the combination of the value vectors.
     matmul_ops = 2 * b * (num_spatial ** 2) * c
-    model.total_ops += th.DoubleTensor([matmul_ops])
+    model.total_ops += torch.DoubleTensor([matmul_ops])
 
 
 class QKVAttentionLegacy(nn.Module):
@@ -342,14 +432,11 @@ class QKVAttentionLegacy(nn.Module):
         bs, width, length = qkv.shape
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
-        q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v)
-        return a.reshape(bs, -1, length)
+        q, k, v = qkv.reshape(bs, self.n_heads, ch * 3, length).transpose(2, 3).split(ch, dim=-1)
+        # Fused attention (FlashAttention / memory-efficient kernels where available);
+        # the [T x T] weight matrix is never materialized. Scales by 1/sqrt(ch).
+        a = F.scaled_dot_product_attention(q, k, v)
+        return a.transpose(2, 3).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
@@ -375,16 +462,12 @@ class QKVAttention(nn.Module):
         bs, width, length = qkv.shape
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
-        q, k, v = qkv.chunk(3, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts",
-            (q * scale).view(bs * self.n_heads, ch, length),
-            (k * scale).view(bs * self.n_heads, ch, length),
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v.reshape(bs * self.n_heads, ch, length))
-        return a.reshape(bs, -1, length)
+        q, k, v = (
+            t.reshape(bs, self.n_heads, ch, length).transpose(2, 3)
+            for t in qkv.chunk(3, dim=1)
+        )
+        a = F.scaled_dot_product_attention(q, k, v)
+        return a.transpose(2, 3).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
@@ -424,8 +507,12 @@ class EchoDNDUNet(nn.Module):
     :param conv_resample: If True, use learned convolutions for up/downsampling.
     :param dims: Dimensionality of the convolution (2 for 2D images).
     :param num_classes: (Not implemented) For class-conditional generation.
-    :param use_checkpoint: If True, use gradient checkpointing.
-    :param use_fp16: If True, use float16 precision.
+    :param use_checkpoint: If True, use gradient checkpointing on each U-Net block
+                           (TimestepEmbedSequential) as a whole.
+    :param use_fp16: If True, run the network under bfloat16 autocast. Weights stay
+                     in float32 and no loss scaling is needed. Export
+                     TORCH_CUDNN_V8_API_ENABLED=1 so cuDNN picks its bf16
+                     convolution kernels.
     :param num_heads: Number of attention heads.
     :param num_head_channels: Width per attention head.
     :param num_heads_upsample: Number of attention heads for upsampling.
@@ -433,6 +520,13 @@ class EchoDNDUNet(nn.Module):
     :param resblock_updown: If True, use ResBlocks for up/downsampling.
     :param use_new_attention_order: If True, use a different attention pattern.
     :param high_way: If True, initialize and use the MFCM
+    :param use_compile: If True, compile each ResBlock and AttentionBlock with torch.compile.
+                        Raises TorchDynamo's cache size limits so that every block
+                        gets compiled, at the cost of one compilation per block.
+    :param share_pathways: If True, the Gaussian and Bernoulli pathways share a single
+                           set of U-Net blocks and are run as one batch of size 2N,
+                           distinguished by a learned task embedding. Only the
+                           output heads remain pathway-specific.
     """
 
     def __init__(
@@ -458,6 +552,8 @@ class EchoDNDUNet(nn.Module):
         resblock_updown=False,
         use_new_attention_order=False,
         high_way = True,
+        use_compile=False,
+        share_pathways=False,
     ):
         super().__init__()
         
@@ -472,6 +568,7 @@ class EchoDNDUNet(nn.Module):
         self.image_size = image_size
         self.in_channels = in_channels
         self.model_channels = model_channels
+        self.dims = dims
         # self.out_channels = out_channels -> NOT USED
         self.num_res_blocks = num_res_blocks
         self.attention_resolutions = attention_resolutions
@@ -480,10 +577,12 @@ class EchoDNDUNet(nn.Module):
         self.conv_resample = conv_resample
         self.num_classes = num_classes
         self.use_checkpoint = use_checkpoint
-        self.dtype = th.float16 if use_fp16 else th.float32
+        self.use_amp = use_fp16
+        self.autocast_dtype = torch.bfloat16
         self.num_heads = num_heads
         self.num_head_channels = num_head_channels
         self.num_heads_upsample = num_heads_upsample
+        self.share_pathways = share_pathways
 
         time_embed_dim = model_channels * 4
         self.time_embed = nn.Sequential(
@@ -518,8 +617,8 @@ class EchoDNDUNet(nn.Module):
                         dropout,
                         out_channels=mult * model_channels,
                         dims=dims,
-                        use_checkpoint=use_checkpoint,
                         use_scale_shift_norm=use_scale_shift_norm,
+                        use_compile=use_compile,
                     )
                 ]
                 ch = mult * model_channels
@@ -527,10 +626,10 @@ class EchoDNDUNet(nn.Module):
                     layers.append(
                         AttentionBlock(
                             ch,
-                            use_checkpoint=use_checkpoint,
                             num_heads=num_heads,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
+                            use_compile=use_compile,
                         )
                     )
                 self.input_blocks_gaussian.append(TimestepEmbedSequential(*layers))
@@ -548,8 +647,8 @@ class EchoDNDUNet(nn.Module):
                             dropout,
                             out_channels=out_ch,
                             dims=dims,
-                            use_checkpoint=use_checkpoint,
                             use_scale_shift_norm=use_scale_shift_norm,
+                            use_compile=use_compile,
                             down=True,
                         )
                         if resblock_updown
@@ -572,23 +671,23 @@ class EchoDNDUNet(nn.Module):
                 time_embed_dim,
                 dropout,
                 dims=dims,
-                use_checkpoint=use_checkpoint,
                 use_scale_shift_norm=use_scale_shift_norm,
+                use_compile=use_compile,
             ),
             AttentionBlock(
                 ch,
-                use_checkpoint=use_checkpoint,
                 num_heads=num_heads,
                 num_head_channels=num_head_channels,
                 use_new_attention_order=use_new_attention_order,
+                use_compile=use_compile,
             ),
             ResBlock(
                 ch,
                 time_embed_dim,
                 dropout,
                 dims=dims,
-                use_checkpoint=use_checkpoint,
                 use_scale_shift_norm=use_scale_shift_norm,
+                use_compile=use_compile,
             ),
         )
         self._feature_size += ch
@@ -605,8 +704,8 @@ class EchoDNDUNet(nn.Module):
                         dropout,
                         out_channels=model_channels * mult,
                         dims=dims,
-                        use_checkpoint=use_checkpoint,
                         use_scale_shift_norm=use_scale_shift_norm,
+                        use_compile=use_compile,
                     )
                 ]
                 ch = model_channels * mult
@@ -614,10 +713,10 @@ class EchoDNDUNet(nn.Module):
                     layers.append(
                         AttentionBlock(
                             ch,
-                            use_checkpoint=use_checkpoint,
                             num_heads=num_heads_upsample,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
+                            use_compile=use_compile,
                         )
                     )
                 if level and i == num_res_blocks:
@@ -629,8 +728,8 @@ class EchoDNDUNet(nn.Module):
                             dropout,
                             out_channels=out_ch,
                             dims=dims,
-                            use_checkpoint=use_checkpoint,
                             use_scale_shift_norm=use_scale_shift_norm,
+                            use_compile=use_compile,
                             up=True,
                         )
                         if resblock_updown
@@ -648,10 +747,16 @@ class EchoDNDUNet(nn.Module):
         )
         
         
-        # Now copy the input_blocks, middle_block, and output_blocks for Bernoulli Diffusion Model
-        self.input_blocks_bernoulli = deepcopy(self.input_blocks_gaussian)
-        self.middle_block_bernoulli = deepcopy(self.middle_block_gaussian)
-        self.output_blocks_bernoulli = deepcopy(self.output_blocks_gaussian)
+        # Now copy the input_blocks, middle_block, and output_blocks for Bernoulli Diffusion Model.
+        # With share_pathways, the *_gaussian blocks are reused for both pathways instead.
+        if share_pathways:
+            # Learned per-pathway token added to the timestep embedding, so the shared
+            # blocks can still tell the Gaussian (0) and Bernoulli (1) inputs apart.
+            self.task_emb = nn.Embedding(2, time_embed_dim)
+        else:
+            self.input_blocks_bernoulli = deepcopy(self.input_blocks_gaussian)
+            self.middle_block_bernoulli = deepcopy(self.middle_block_gaussian)
+            self.output_blocks_bernoulli = deepcopy(self.output_blocks_gaussian)
         # The final output block for Bernoulli Diffusion Model
         self.out_bernoulli = nn.Sequential(
             normalization(ch),
@@ -662,11 +767,305 @@ class EchoDNDUNet(nn.Module):
         if high_way:
             features = 32
             self.mfcm = HRNet(in_ch=self.in_channels - 1, out_ch=1, mid_ch=features,num_stage=4)
+
+        # Side streams on which the Gaussian and Bernoulli pathways run concurrently.
+        # They are created lazily in forward() so that they live on the input's device.
+        self.stream_g = None
+        self.stream_b = None
+
+        # CUDA graph of one sampling step and its static inputs/outputs, see capture().
+        self.graph = None
+        self.static_x = None
+        self.static_t = None
+        self.static_out = None
+
+        # MFCM outputs for a fixed conditioning image, see set_condition().
+        self._cached_inject = None
+        self._cached_cal = None
+
+        # Optional [T x time_embed_dim] table of timestep embeddings, see precompute_emb().
+        self.register_buffer("emb_cache", None, persistent=False)
+
+        if dims == 2:
+            # cuDNN's tensor-core convolution kernels are NHWC-native; keeping weights and
+            # activations channels_last avoids layout transposes around every conv.
+            self.to(memory_format=torch.channels_last)
+
+        if use_compile:
+            # Counted after the Bernoulli deep copies, which share the same code objects.
+            raise_compile_cache_limit(
+                max(
+                    sum(isinstance(m, ResBlock) for m in self.modules()),
+                    sum(isinstance(m, AttentionBlock) for m in self.modules()),
+                )
+            )
+
+    def precompute_emb(self, num_timesteps):
+        """
+        Cache the embeddings of all integer timesteps in [0, num_timesteps).
+
+        forward() then indexes this table instead of running time_embed at every
+        sampling step. Floating-point timesteps, e.g. from a diffusion that rescales
+        them, bypass the table and are embedded as usual. The cache goes stale as
+        soon as the weights change, so it is dropped when the model is put back
+        into train mode or loads a state dict.
+
+        :param num_timesteps: the number of timesteps of the original schedule.
+        """
+        # A captured graph reads the old table, which is freed once it is rebound.
+        self.release_graph()
+        timesteps = torch.arange(num_timesteps, device=self.time_embed[0].weight.device)
+        with torch.no_grad():
+            self.emb_cache = self.time_embed(
+                timestep_embedding(timesteps, self.model_channels)
+            )
+
+    def set_condition(self, x_img):
+        """
+        Run the MFCM once on a conditioning image and reuse its outputs.
+
+        The conditioning image stays the same across all steps of a sampling run.
+        While a condition is set, forward() therefore skips the MFCM and ignores
+        the image channel of its input for it. Call clear_condition() before
+        moving on to another image. Meant for sampling only: no gradients flow
+        into the MFCM.
+
+        :param x_img: an [N x 1 x ...] Tensor of conditioning images.
+        """
+        with torch.no_grad(), torch.autocast(
+            x_img.device.type,
+            dtype=self.autocast_dtype,
+            enabled=self.use_amp,
+            cache_enabled=False,
+        ):
+            anch, cal = self.mfcm_forward(x_img)
+            inject = torch.cat((anch[0], anch[0], anch[1]),1)
+        if (
+            self._cached_inject is not None
+            and self._cached_inject.shape == inject.shape
+            and self._cached_inject.dtype == inject.dtype
+        ):
+            # Update in place: a captured CUDA graph reads these very tensors.
+            self._cached_inject.copy_(inject)
+            self._cached_cal.copy_(cal)
+        else:
+            # A graph captured against the old tensors would read freed memory.
+            self.release_graph()
+            self._cached_inject = inject
+            self._cached_cal = cal
+
+    def clear_condition(self):
+        """Forget the MFCM outputs stored by set_condition()."""
+        if self._cached_inject is not None:
+            # A graph captured while the condition was set would read freed memory.
+            self.release_graph()
+        self._cached_inject = None
+        self._cached_cal = None
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # The cached embeddings were computed from the weights being replaced, and a
+        # captured graph reads the table that is dropped here.
+        self.release_graph()
+        self.emb_cache = None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def train(self, mode=True):
+        if mode:
+            # The graph was captured in eval mode and reads emb_cache, which is dropped here.
+            self.release_graph()
+            self.emb_cache = None
+            self.clear_condition()
+        return super().train(mode)
+
+    def _ensure_streams(self, device):
+        """Create (or move) the per-pathway CUDA streams for `device`."""
+        if self.stream_g is None or self.stream_g.device != device:
+            self.stream_g = torch.cuda.Stream(device=device)
+            self.stream_b = torch.cuda.Stream(device=device)
     
     def mfcm_forward(self,x):
         """Passes input through the Multi-scale Fusion Conditioning Module (MFCM)."""
         return self.mfcm(x)
 
+    def _run_block(self, block, h, emb):
+        """
+        Apply one TimestepEmbedSequential block.
+
+        With use_checkpoint, the whole block is checkpointed, so its activations are
+        recomputed in the backward pass. Checkpointing is skipped when gradients
+        are disabled, e.g. during sampling.
+        """
+        if self.use_checkpoint and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(block, h, emb, use_reentrant=False)
+        return block(h, emb)
+
+    def _forward_dual(self, x, h_gaussian, h_bernoulli, emb, inject):
+        """
+        Run the two pathways through their own blocks, concurrently on GPU.
+
+        :return: the final Gaussian and Bernoulli features before the output heads.
+        """
+        hs_gaussian = []
+        hs_bernoulli = []
+
+        # The two pathways share no data until the output heads, so on GPU each one is
+        # issued on its own stream. torch.cuda.stream(None) is a no-op on CPU.
+        stream_g = stream_b = None
+        if x.is_cuda:
+            self._ensure_streams(x.device)
+            stream_g, stream_b = self.stream_g, self.stream_b
+            current_stream = torch.cuda.current_stream(x.device)
+            stream_g.wait_stream(current_stream)
+            stream_b.wait_stream(current_stream)
+            # Tensors produced on the current stream must not be recycled by the
+            # allocator while the side streams are still reading them.
+            for tensor in (emb, inject):
+                tensor.record_stream(stream_g)
+                tensor.record_stream(stream_b)
+            h_gaussian.record_stream(stream_g)
+            h_bernoulli.record_stream(stream_b)
+
+        # The first input block also receives the MFCM features.
+        with torch.cuda.stream(stream_g):
+            h_gaussian = self._run_block(self.input_blocks_gaussian[0], h_gaussian, emb)
+            h_gaussian.add_(inject)
+            hs_gaussian.append(h_gaussian)
+        with torch.cuda.stream(stream_b):
+            h_bernoulli = self._run_block(self.input_blocks_bernoulli[0], h_bernoulli, emb)
+            h_bernoulli.add_(inject)
+            hs_bernoulli.append(h_bernoulli)
+
+        for ind in range(1, len(self.input_blocks_gaussian)):
+            with torch.cuda.stream(stream_g):
+                h_gaussian = self._run_block(self.input_blocks_gaussian[ind], h_gaussian, emb)
+                hs_gaussian.append(h_gaussian)
+            with torch.cuda.stream(stream_b):
+                h_bernoulli = self._run_block(self.input_blocks_bernoulli[ind], h_bernoulli, emb)
+                hs_bernoulli.append(h_bernoulli)
+
+        with torch.cuda.stream(stream_g):
+            h_gaussian = self._run_block(self.middle_block_gaussian, h_gaussian, emb)
+        with torch.cuda.stream(stream_b):
+            h_bernoulli = self._run_block(self.middle_block_bernoulli, h_bernoulli, emb)
+
+        for ind in range(len(self.output_blocks_gaussian)):
+            with torch.cuda.stream(stream_g):
+                h_gaussian = torch.cat([h_gaussian, hs_gaussian.pop()], dim=1)
+                h_gaussian = self._run_block(self.output_blocks_gaussian[ind], h_gaussian, emb)
+            with torch.cuda.stream(stream_b):
+                h_bernoulli = torch.cat([h_bernoulli, hs_bernoulli.pop()], dim=1)
+                h_bernoulli = self._run_block(self.output_blocks_bernoulli[ind], h_bernoulli, emb)
+
+        if x.is_cuda:
+            # Join both pathways back onto the current stream before the output heads.
+            current_stream.wait_stream(stream_g)
+            current_stream.wait_stream(stream_b)
+            h_gaussian.record_stream(current_stream)
+            h_bernoulli.record_stream(current_stream)
+
+        return h_gaussian, h_bernoulli
+
+    def _forward_shared(self, x_img, noise_gaussian, noise_bernoulli, emb, inject):
+        """
+        Run both pathways through the shared blocks as a single batch of size 2N.
+
+        :return: the final Gaussian and Bernoulli features before the output heads.
+        """
+        hs = []
+        # [2N x D]: the first N rows carry the Gaussian task token, the last N the Bernoulli one.
+        emb = (emb[None] + self.task_emb.weight[:, None]).reshape(-1, emb.shape[-1])
+
+        # The first block is a single conv over cat(image, noise). Being linear, it splits
+        # into an image part, computed once for both pathways, and a noise part.
+        first_block = self.input_blocks_gaussian[0]
+        assert len(first_block) == 1 and isinstance(
+            first_block[0], nn.Conv2d
+        ), "share_pathways expects the first input block to be a single 2D conv"
+        conv = first_block[0]
+        img_channels = x_img.shape[1]
+        img_feat = F.conv2d(
+            x_img, conv.weight[:, :img_channels], conv.bias, conv.stride, conv.padding
+        )
+        h = F.conv2d(
+            torch.cat([noise_gaussian, noise_bernoulli], dim=0),
+            conv.weight[:, img_channels:],
+            None,
+            conv.stride,
+            conv.padding,
+        )
+        # The first input block also receives the MFCM features.
+        h.view(2, -1, *h.shape[1:]).add_(img_feat.add_(inject))
+        hs.append(h)
+
+        for ind in range(1, len(self.input_blocks_gaussian)):
+            h = self._run_block(self.input_blocks_gaussian[ind], h, emb)
+            hs.append(h)
+
+        h = self._run_block(self.middle_block_gaussian, h, emb)
+
+        for ind in range(len(self.output_blocks_gaussian)):
+            h = torch.cat([h, hs.pop()], dim=1)
+            h = self._run_block(self.output_blocks_gaussian[ind], h, emb)
+
+        h_gaussian, h_bernoulli = h.chunk(2, dim=0)
+        return h_gaussian, h_bernoulli
+
+    def capture(self, sample_x, sample_t):
+        """
+        Record one sampling step into a CUDA graph.
+
+        Afterwards, forward() calls made without gradients whose inputs match
+        `sample_x` and `sample_t` in shape, dtype and device copy their inputs into
+        static buffers and replay the graph instead of launching every kernel from
+        Python. Call release_graph() before changing the weights or input shapes.
+
+        Capturing is opt-in; the inference script does it with --use_cuda_graph.
+        precompute_emb() must have been called and the timesteps must be integers:
+        computing the sinusoidal embedding copies its frequencies to the device,
+        which is not allowed while a stream is capturing.
+
+        :param sample_x: an example [N x 3 x ...] input on a CUDA device.
+        :param sample_t: an example 1-D batch of integer timesteps.
+        """
+        assert self.emb_cache is not None, "call precompute_emb() before capture()"
+        assert not sample_t.is_floating_point(), "capture() needs integer timesteps"
+        self.release_graph()
+        self.static_x = sample_x.detach().clone()
+        self.static_t = sample_t.detach().clone()
+
+        device = self.static_x.device
+        warmup_stream = torch.cuda.Stream(device=device)
+        warmup_stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.no_grad(), torch.cuda.stream(warmup_stream):
+            for _ in range(3):
+                self._forward(self.static_x, self.static_t)
+        torch.cuda.current_stream(device).wait_stream(warmup_stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(graph):
+            self.static_out = self._forward(self.static_x, self.static_t)
+        self.graph = graph
+
+    def release_graph(self):
+        """Drop the CUDA graph recorded by capture(), if any."""
+        self.graph = None
+        self.static_x = None
+        self.static_t = None
+        self.static_out = None
+
+    def _can_replay(self, x, timesteps, y):
+        return (
+            self.graph is not None
+            and not self.training
+            and y is None
+            and not torch.is_grad_enabled()
+            and x.shape == self.static_x.shape
+            and x.dtype == self.static_x.dtype
+            and x.device == self.static_x.device
+            and timesteps.shape == self.static_t.shape
+            and timesteps.dtype == self.static_t.dtype
+        )
+
     ####### NEW Forward Function - Takes x without noise, gaussian_noise and bernoulli noise #######
     def forward(self, x, timesteps, y=None):
         """
@@ -678,6 +1077,15 @@ class EchoDNDUNet(nn.Module):
         :param y: an [N] Tensor of labels, if class-conditional.
         :return: a tuple of two [N x C x ...] Tensors of outputs for gaussian and bernoulli respectively.
         """
+        if self._can_replay(x, timesteps, y):
+            self.static_x.copy_(x)
+            self.static_t.copy_(timesteps)
+            self.graph.replay()
+            # The static outputs are overwritten by the next replay.
+            return tuple(out.clone() for out in self.static_out)
+        return self._forward(x, timesteps, y)
+
+    def _forward(self, x, timesteps, y=None):
         assert x.shape[1] == 3, "Input must have 3 channels"
         
         x_img, noise_gaussian, noise_bernoulli = x[:,0:1], x[:,1:2], x[:,2:3]
@@ -686,42 +1094,58 @@ class EchoDNDUNet(nn.Module):
             self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional"
         
-        hs_gaussian = []
-        hs_bernoulli = []
-        emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
-
         if self.num_classes is not None:
             raise NotImplementedError("Class-conditional model not implemented")
 
-        anch, cal = self.mfcm_forward(x_img)
-
-        h_gaussian = th.cat([x_img, noise_gaussian], dim=1).type(self.dtype)
-        h_bernoulli = th.cat([x_img, noise_bernoulli], dim=1).type(self.dtype)
+        # Each weight is cast once per forward, so autocast's weight cache buys nothing here;
+        # it is also unsafe under CUDA graph capture.
+        with torch.autocast(
+            x.device.type,
+            dtype=self.autocast_dtype,
+            enabled=self.use_amp,
+            cache_enabled=False,
+        ):
+            if self.emb_cache is not None and not timesteps.is_floating_point():
+                emb = self.emb_cache[timesteps]
+            else:
+                emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
+            emb = emb.squeeze() if emb.dim() > 2 else emb
+
+            # MFCM features added to the output of the first input block of both pathways.
+            if self._cached_inject is not None:
+                assert (
+                    self._cached_inject.shape[0] == x.shape[0]
+                    and self._cached_inject.shape[2:] == x.shape[2:]
+                ), (
+                    "condition set for batch/spatial size "
+                    f"{(self._cached_inject.shape[0], *self._cached_inject.shape[2:])} does not "
+                    f"match input batch/spatial size {(x.shape[0], *x.shape[2:])}; call "
+                    "set_condition() with the current images or clear_condition()"
+                )
+                # Clone so the returned map is not overwritten by a later set_condition().
+                inject, cal = self._cached_inject, self._cached_cal.clone()
+            else:
+                anch, cal = self.mfcm_forward(x_img)
+                inject = torch.cat((anch[0], anch[0], anch[1]),1).detach()
 
-        for ind in range(len(self.input_blocks_gaussian)):
-            if len(emb.size()) > 2:
-                emb = emb.squeeze()
-            h_gaussian = self.input_blocks_gaussian[ind](h_gaussian, emb)
-            h_bernoulli = self.input_blocks_bernoulli[ind](h_bernoulli, emb)
-            if ind == 0:
-                h_gaussian = h_gaussian + th.cat((anch[0], anch[0], anch[1]),1).detach()
-                h_bernoulli = h_bernoulli + th.cat((anch[0], anch[0], anch[1]),1).detach()
-            hs_gaussian.append(h_gaussian)
-            hs_bernoulli.append(h_bernoulli)
-            
-        h_gaussian = self.middle_block_gaussian(h_gaussian, emb)
-        h_bernoulli = self.middle_block_bernoulli(h_bernoulli, emb)
-        
-        for ind in range(len(self.output_blocks_gaussian)):
-            h_gaussian = th.cat([h_gaussian, hs_gaussian.pop()], dim=1)
-            h_gaussian = self.output_blocks_gaussian[ind](h_gaussian, emb)
-            h_bernoulli = th.cat([h_bernoulli, hs_bernoulli.pop()], dim=1)
-            h_bernoulli = self.output_blocks_bernoulli[ind](h_bernoulli, emb)
-        
+            if self.share_pathways:
+                h_gaussian, h_bernoulli = self._forward_shared(
+                    x_img, noise_gaussian, noise_bernoulli, emb, inject
+                )
+            else:
+                h_gaussian = torch.cat([x_img, noise_gaussian], dim=1)
+                h_bernoulli = torch.cat([x_img, noise_bernoulli], dim=1)
+                if self.dims == 2:
+                    h_gaussian = h_gaussian.contiguous(memory_format=torch.channels_last)
+                    h_bernoulli = h_bernoulli.contiguous(memory_format=torch.channels_last)
+                h_gaussian, h_bernoulli = self._forward_dual(x, h_gaussian, h_bernoulli, emb, inject)
+
+        # The output heads run in full precision.
         h_gaussian = h_gaussian.type(x_img.dtype)
         h_bernoulli = h_bernoulli.type(x_img.dtype)
-        
+        cal = cal.type(x_img.dtype)
+
         out_gaussian = self.out_gaussian(h_gaussian)
         out_bernoulli = self.out_bernoulli(h_bernoulli)
         
-        return out_gaussian, out_bernoulli, cal
\ No newline at end of file
+        return out_gaussian, out_bernoulli, cal
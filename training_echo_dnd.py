@@ -19,6 +19,11 @@ def main():
     print("GPU AVAILABLE:", th.cuda.is_available())
     args = create_argparser().parse_args()
     print("Arguments: ", args)
+
+    # Outside autocast, let fp32 matmuls and convolutions run on TF32 tensor cores
+    # (Ampere and newer); accumulation stays in fp32.
+    th.set_float32_matmul_precision("high")
+    th.backends.cudnn.allow_tf32 = True
     
     logger.configure(dir=args.out_dir)
 
@@ -99,7 +104,7 @@ def main():
         log_interval=args.log_interval,
         save_interval=args.save_interval,
         resume_checkpoint=args.resume_checkpoint,
-        use_fp16=args.use_fp16,
+        use_fp16=False, # EchoDNDUNet applies bf16 autocast itself; no fp16 master weights or loss scaling
         fp16_scale_growth=args.fp16_scale_growth,
         schedule_sampler=schedule_sampler,
         weight_decay=args.weight_decay,